@@ -1,9 +1,18 @@
-import os
 import gc
+from functools import partial
 from io import BytesIO
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
 import plotly.express as px
+import xlsxwriter
 import streamlit as st
+from convert_to_parquet import OUTPUT_ARROW, rate_per_thousand, read_communes_ref
+from dashboard_common import crime_source, enable_copy_on_write, ensure_crime_files, load_dep_geojson
+
+enable_copy_on_write()
 
 # ----------------------------------
 # Config
@@ -18,11 +27,25 @@ st.set_page_config(
 # Constants
 # ----------------------------------
 MAX_ROWS = 200_000
-DEPARTEMENTS_GEOJSON = "https://france-geojson.gregoiredavid.fr/repo/departements.geojson"
+CRIME_COLUMNS = ["CODGEO_2025","DEP","annee","indicateur","nombre"]
+ENRICHED_COLUMNS = CRIME_COLUMNS + ["Commune","Population"]
+WIDGET_CACHE_TTL = 3600  # secondes : borne la mémoire des résultats par combinaison de filtres
+FRAME_CACHE_ENTRIES = 32  # tables filtrées gardées en cache, les plus anciennes sont évincées
+EXPORT_CACHE_ENTRIES = 4  # classeurs Excel (~12 Mo pour la France) gardés en cache
 
 # ----------------------------------
 # Helpers
 # ----------------------------------
+def _shrink(df):
+    """Downcast 64-bit numeric columns so the figure JSON is about half the size."""
+    dtypes = {}
+    for col, dtype in df.dtypes.items():
+        if dtype == "float64":
+            dtypes[col] = "float32"
+        elif dtype == "int64" and df[col].abs().max() < 2**31:
+            dtypes[col] = "int32"
+    return df.astype(dtypes) if dtypes else df
+
 def safe_chart(df, render_fn, *args, **kwargs):
     """Safely show plot with warnings if too big."""
     if df is None or df.empty:
@@ -32,239 +55,419 @@ def safe_chart(df, render_fn, *args, **kwargs):
         st.warning(f"🚨 Trop de données ({len(df):,} lignes). Veuillez affiner vos filtres.")
         return
     try:
-        fig = render_fn(df, *args, **kwargs)
+        fig = render_fn(_shrink(df), *args, **kwargs)
         st.plotly_chart(fig, use_container_width=True)
     except Exception as e:
         st.error(f"Erreur lors du rendu : {e}")
 
-def derive_dep(code: str) -> str:
-    if not isinstance(code, str) or len(code) < 2:
-        return None
-    if code.startswith(("97", "98")):
-        return code[:3]
-    if code[:2] in ("2A","2B"):
-        return code[:2]
-    return code[:2]
-
 # ----------------------------------
 # Data Loaders
 # ----------------------------------
-@st.cache_data
-def load_crime_data():
-    candidates = ["crime_2016_latest.csv.gz", "crime_2016_2024.csv.gz"]
-    file_to_use = next((f for f in candidates if os.path.exists(f)), None)
-    if not file_to_use:
-        st.stop()
-    df = pd.read_csv(file_to_use, sep=";", compression="gzip", dtype={"CODGEO_2025":str})
-    df["annee"]  = pd.to_numeric(df["annee"], errors="coerce")
-    df["nombre"] = pd.to_numeric(df["nombre"], errors="coerce")
-    return df, file_to_use
+@st.cache_resource
+def load_crime_table():
+    """Memory-mapped Arrow table, shared zero-copy by every session."""
+    ensure_crime_files(ENRICHED_COLUMNS)
+    return ipc.open_file(pa.memory_map(OUTPUT_ARROW, "r")).read_all()
 
 @st.cache_data
 def load_communes_ref():
-    ref = pd.read_csv("v_commune_2025.csv", dtype=str)
-    return ref.rename(columns={"COM":"CODGEO_2025","LIBELLE":"Commune"})[["CODGEO_2025","Commune"]]
+    ref = read_communes_ref()
+    # Libellés en catégorie : égalité / isin sur codes entiers
+    ref["Commune"] = ref["Commune"].astype("category")
+    return ref
+
+@st.cache_data
+def sorted_commune_names():
+    return tuple(sorted(load_communes_ref()["Commune"].dropna().unique()))
+
+@st.cache_resource
+def commune_names_lower():
+    # Aligné ligne à ligne sur load_communes_ref() pour servir de masque ;
+    # minuscules précalculées : la recherche devient une sous-chaîne simple (sans regex)
+    names = pa.array(load_communes_ref()["Commune"], type=pa.string(), from_pandas=True)
+    return pc.utf8_lower(names)
 
 @st.cache_data
-def load_population_data():
-    pop = pd.read_csv("population_long.csv", dtype={"codgeo":str,"annee":int})
-    pop["codgeo"] = pop["codgeo"].str.zfill(5)
-    pop["Population"] = pd.to_numeric(pop["Population"], errors="coerce")
-    return pop.rename(columns={"codgeo":"CODGEO"})[["CODGEO","annee","Population"]]
+def sorted_years():
+    return tuple(sorted(pc.unique(load_crime_table()["annee"]).drop_null().to_pylist(), reverse=True))
+
+@st.cache_data
+def sorted_indicateurs():
+    indicateurs = load_crime_table()["indicateur"].unify_dictionaries().chunk(0).dictionary
+    return tuple(sorted(indicateurs.to_pylist()))
+
+@st.cache_data
+def dep_list():
+    # Codes département lus dans le dictionnaire de la colonne DEP (déjà dérivée à la conversion)
+    deps = load_crime_table()["DEP"].unify_dictionaries().chunk(0).dictionary
+    return tuple(sorted(deps.to_pylist()))
+
+@st.cache_data
+def dep_geojson_subset(deps):
+    """Departments GeoJSON restricted to the given codes, to shrink the map payload."""
+    geojson = load_dep_geojson()
+    if isinstance(geojson, str):
+        return geojson
+    keep = set(deps)
+    return {**geojson, "features": [f for f in geojson["features"] if f["properties"].get("code") in keep]}
 
 # ----------------------------------
 # Data Prep
 # ----------------------------------
-@st.cache_data
-def prepare_data(annee_choice=None, communes_choice=None, dep_choice=None, include_all_years=False):
-    crime, _ = load_crime_data()
-    ref = load_communes_ref()
-    pop = load_population_data()
+def scan_crime(filters=None):
+    """Filter the memory-mapped crime table, converting only the matching rows."""
+    table = load_crime_table().select(ENRICHED_COLUMNS)
+    if filters:
+        table = table.filter(pq.filters_to_expression(filters))
+    return table.to_pandas()
 
-    crime = crime.merge(ref, on="CODGEO_2025", how="left")
-    crime["DEP"] = crime["CODGEO_2025"].map(derive_dep)
+def scan_prepared(annee_choice=None, communes_choice=None, dep_choice=None):
+    ref = load_communes_ref()
 
-    if not include_all_years and annee_choice is not None:
-        crime = crime[crime["annee"] == annee_choice]
+    # Commune et Population sont déjà dans la table : uniquement des filtres,
+    # appliqués côté Arrow avant conversion (année, codes des communes, département)
+    filters = []
+    if annee_choice is not None:
+        filters.append(("annee", "==", int(annee_choice)))
     if communes_choice:
-        crime = crime[crime["Commune"].isin(communes_choice)]
+        # Une seule commune (cas courant) : simple égalité, sans table de hachage isin
+        if len(communes_choice)==1:
+            in_choice = ref["Commune"]==communes_choice[0]
+        else:
+            in_choice = ref["Commune"].isin(communes_choice)
+        codes = ref.loc[in_choice, "CODGEO_2025"].unique().tolist()
+        filters.append(("CODGEO_2025", "in", codes))
     if dep_choice:
-        crime = crime[crime["DEP"] == dep_choice]
+        filters.append(("DEP", "==", dep_choice))
+    df = scan_crime(filters)
 
-    df = crime.merge(pop, left_on=["CODGEO_2025","annee"], right_on=["CODGEO","annee"], how="left")
-    df["taux_calcule_pour_mille"] = (df["nombre"]/df["Population"])*1000
-    df.loc[df["Population"].isna() | (df["Population"]<=0), "taux_calcule_pour_mille"] = pd.NA
+    df["taux_calcule_pour_mille"] = rate_per_thousand(df["nombre"], df["Population"])
     return df
 
+@st.cache_data(max_entries=FRAME_CACHE_ENTRIES)
+def prepare_all_years(commune_key=None, dep_choice=None):
+    """All-years frame for a commune/department filter, shared by every tab."""
+    return scan_prepared(None, list(commune_key) if commune_key else None, dep_choice)
+
+@st.cache_data(max_entries=FRAME_CACHE_ENTRIES)
+def prepare_data(annee_choice=None, communes_choice=None, dep_choice=None, include_all_years=False):
+    commune_key = tuple(sorted(communes_choice)) if communes_choice else None
+    if commune_key is None and dep_choice is None:
+        # Sans filtre géographique, l'année reste poussée dans le scan Arrow
+        # (inutile de matérialiser toute la France toutes années)
+        return scan_prepared(None if include_all_years else annee_choice)
+    df = prepare_all_years(commune_key, dep_choice)
+    if include_all_years or annee_choice is None:
+        return df
+    return df.loc[lambda d: d["annee"]==annee_choice]
+
+def arrow_groupby(data, keys, aggs):
+    """Group with Arrow's hash aggregation; returns pandas, columns named as their source."""
+    if isinstance(data, pd.DataFrame):
+        data = pa.Table.from_pandas(data, preserve_index=False)
+    agg = data.group_by(keys).aggregate(aggs)
+    # Sélection par nom (« <colonne>_<fonction> ») : la position des clés dans la
+    # sortie a changé selon les versions de pyarrow
+    agg = agg.select(keys + [f"{col}_{fn}" for col, fn in aggs])
+    agg = agg.rename_columns(keys + [col for col, _ in aggs]).to_pandas()
+    # Même ordre de sortie qu'un groupby pandas trié
+    return agg.sort_values(keys, ignore_index=True)
+
+# Agrégats sur toute la table : calculés par le moteur Arrow (agrégation par
+# hachage vectorisée sur les codes de dictionnaire) directement sur le fichier
+# mappé, sans conversion pandas des millions de lignes
+@st.cache_data
+def load_dep_agg():
+    return arrow_groupby(load_crime_table(), ["annee","DEP","indicateur"], [("nombre","sum")])
+
+@st.cache_data
+def load_crime_totals():
+    """Crime totals per commune and year, all indicators summed."""
+    # Population identique pour une commune et une année : max équivaut à first
+    return arrow_groupby(
+        load_crime_table(), ["annee","CODGEO_2025","DEP","Commune"],
+        [("nombre","sum"),("Population","max")]
+    )
+
+def zone_frame(commune_choice, dep_choice=None, annee_choice=None):
+    """Rows for the selected area: department aggregate for France, commune rows otherwise."""
+    if commune_choice=="France":
+        # Agrégat départemental pré-calculé : pas de prepare_data sans filtre commune
+        df = load_dep_agg()
+        if dep_choice:
+            df = df[df["DEP"]==dep_choice]
+        if annee_choice is not None:
+            df = df[df["annee"]==annee_choice]
+        return df
+    if annee_choice is None:
+        return prepare_data(None, (commune_choice,), dep_choice, include_all_years=True)
+    return prepare_data(annee_choice, (commune_choice,), dep_choice)
+
+# Résultats finaux par onglet, mis en cache par combinaison de filtres (scalaires) :
+# après échauffement, un rerun n'est plus qu'une lecture de cache
+@st.cache_data(ttl=WIDGET_CACHE_TTL)
+def map_frame(annee_choice, indic_choice, commune_choice, dep_choice=None):
+    # Filtre indicateur d'abord, puis un seul groupby par département (~100 lignes)
+    df_map = zone_frame(commune_choice, dep_choice, annee_choice)
+    if indic_choice!="Tous les crimes confondus":
+        df_map = df_map[df_map["indicateur"]==indic_choice]
+    return df_map.groupby("DEP",as_index=False,observed=True,sort=False)["nombre"].sum()
+
+@st.cache_data(ttl=WIDGET_CACHE_TTL)
+def repartition_frame(annee_choice, indic_choice, commune_choice, dep_choice=None):
+    if indic_choice=="Tous les crimes confondus":
+        df_r = zone_frame(commune_choice, dep_choice, annee_choice)
+        return df_r.groupby("indicateur", as_index=False, observed=True)["nombre"].sum()
+    # Filtres commune en tuple : clé de cache canonique, partagée avec les autres onglets
+    df_r = prepare_data(annee_choice, None if commune_choice=="France" else (commune_choice,), dep_choice)
+    return df_r[df_r["indicateur"]==indic_choice]
+
+@st.cache_data(ttl=WIDGET_CACHE_TTL)
+def evolution_frame(indic_choice, commune_choice, dep_choice=None):
+    # Un point par (année, indicateur) : la courbe reste petite quelle que soit la zone
+    evol = zone_frame(commune_choice, dep_choice)
+    evol = evol.groupby(["annee","indicateur"],observed=True,as_index=False)["nombre"].sum()
+    if indic_choice=="Tous les crimes confondus":
+        top_indics = evol.groupby("indicateur",observed=True,sort=False)["nombre"].sum().nlargest(10).index
+        return evol[evol["indicateur"].isin(top_indics)]
+    return evol[evol["indicateur"]==indic_choice]
+
+@st.cache_data(ttl=WIDGET_CACHE_TTL)
+def commune_history(codgeo):
+    """All-years rows of one commune, filtered on its INSEE code in the Arrow scan."""
+    return scan_crime([("CODGEO_2025", "==", codgeo)])
+
+@st.cache_data(ttl=WIDGET_CACHE_TTL)
+def heatmap_pivot(commune_choice, dep_choice=None):
+    df_h = zone_frame(commune_choice, dep_choice)
+    # Une seule agrégation (somme + mise en forme), sans produit cartésien des catégories
+    return df_h.pivot_table(
+        index="indicateur", columns="annee", values="nombre",
+        aggfunc="sum", observed=True, fill_value=0, sort=False
+    )
+
 # ----------------------------------
 # Classement + Export
 # ----------------------------------
-@st.cache_data
-def compute_ranking(df, indic_choice, n):
+@st.cache_data(ttl=WIDGET_CACHE_TTL)
+def compute_ranking(annee_choice, indic_choice, dep_choice, n):
+    # Clé de cache scalaire : le DataFrame est reconstruit via les loaders (eux-mêmes en cache)
     if indic_choice=="Tous les crimes confondus":
-        rank = df.groupby(["Commune","CODGEO_2025"],as_index=False).agg(
-            Total_crimes=("nombre","sum"),
-            Population=("Population","first")
-        )
+        # Totaux tous indicateurs déjà agrégés par commune et année : pas de groupby ici
+        rank = load_crime_totals()
+        rank = rank[rank["annee"]==annee_choice]
+        if dep_choice:
+            rank = rank[rank["DEP"]==dep_choice]
+        rank = rank.rename(columns={"nombre":"Total_crimes"})[["Commune","CODGEO_2025","Total_crimes","Population"]]
     else:
-        rank = df[df["indicateur"]==indic_choice].groupby(
-            ["Commune","CODGEO_2025"],as_index=False
+        # Indicateur poussé dans le scan Arrow avec l'année : seules les lignes
+        # utiles (une par commune) sont converties en pandas
+        filters = [("annee","==",int(annee_choice)), ("indicateur","==",indic_choice)]
+        if dep_choice:
+            filters.append(("DEP","==",dep_choice))
+        rank = scan_crime(filters).groupby(
+            ["Commune","CODGEO_2025"],as_index=False,observed=True,sort=False
         ).agg(
             Total_crimes=("nombre","sum"),
             Population=("Population","first")
         )
     rank["Taux_pour_mille"] = (rank["Total_crimes"]/rank["Population"])*1000
-    res = rank.sort_values("Total_crimes",ascending=False).head(n)
+    res = rank.nlargest(n, "Total_crimes")
     del rank; gc.collect()
     return res
 
-def create_excel_rankings(df, year=None):
-    df_temp = df.copy()
-    if year is not None:
-        df_temp = df_temp[df_temp["annee"] == year]
+def _write_sheet(workbook, sheet_name, df):
+    # Écriture ligne par ligne (compatible constant_memory), cellules vides pour NaN
+    ws = workbook.add_worksheet(sheet_name)
+    ws.write_row(0, 0, [str(c) for c in df.columns])
+    values = df.astype(object).where(df.notna(), None)
+    for i, row in enumerate(values.itertuples(index=False, name=None), start=1):
+        ws.write_row(i, 0, row)
 
-    general_rank = (
-        df_temp.groupby(["CODGEO_2025","Commune"],as_index=False)
-        .agg(Total_crimes=("nombre","sum"), Types_crimes=("indicateur","nunique"))
-        .sort_values("Total_crimes",ascending=False)
-    )
+@st.cache_data(ttl=WIDGET_CACHE_TTL, max_entries=EXPORT_CACHE_ENTRIES)
+def create_excel_rankings(annee_choice, dep_choice=None):
+    # Totaux par commune déjà agrégés (partagés avec le classement « Tous ») :
+    # l'export ne fait plus que trier et écrire
+    totals = load_crime_totals()
+    totals = totals[totals["annee"]==annee_choice]
+    if dep_choice:
+        totals = totals[totals["DEP"]==dep_choice]
+    totals = totals.rename(columns={"nombre":"Total_crimes"})
+    df = prepare_data(annee_choice, dep_choice=dep_choice)
 
-    taux_rank = (
-        df_temp.groupby(["CODGEO_2025","Commune","annee"],as_index=False)
-        .agg(Total_crimes=("nombre","sum"), Population=("Population","first"))
-    )
-    taux_rank["Taux_pour_mille"] = (taux_rank["Total_crimes"]/taux_rank["Population"])*1000
-    taux_rank = taux_rank.sort_values("Taux_pour_mille",ascending=False)
+    # Une ligne par (commune, année, indicateur) : nombre de lignes = indicateurs distincts
+    n_types = df["CODGEO_2025"].value_counts()
+    general_rank = totals[["CODGEO_2025","Commune","Total_crimes"]].assign(
+        Types_crimes=n_types.reindex(totals["CODGEO_2025"]).to_numpy()
+    ).sort_values("Total_crimes",ascending=False)
+
+    # assign sur la sélection : pas de copie explicite avant d'ajouter le taux
+    taux_rank = totals[["CODGEO_2025","Commune","annee","Total_crimes","Population"]].assign(
+        Taux_pour_mille=totals["Total_crimes"]/totals["Population"]*1000
+    ).sort_values("Taux_pour_mille",ascending=False)
 
+    # xlsxwriter en constant_memory : chaque ligne est vidée sur disque dès
+    # qu'elle est écrite (pd.ExcelWriter écrit colonne par colonne, incompatible).
+    # Taux infini (population nulle) écrit en erreur Excel plutôt qu'une exception
     output = BytesIO()
-    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-        general_rank.to_excel(writer, sheet_name="General", index=False)
-        taux_rank.to_excel(writer, sheet_name="Taux_1000", index=False)
-
-        for indic in sorted(df_temp["indicateur"].dropna().unique()):
-            subset = (
-                df_temp[df_temp["indicateur"] == indic]
-                .groupby(["CODGEO_2025","Commune","annee"],as_index=False)
-                .agg(Total_crimes=("nombre","sum"), Population=("Population","first"))
-            )
+    with xlsxwriter.Workbook(output, {"constant_memory": True, "nan_inf_to_errors": True}) as writer:
+        _write_sheet(writer, "General", general_rank)
+        _write_sheet(writer, "Taux_1000", taux_rank)
+
+        # Un seul partitionnement par indicateur (catégories triées) au lieu d'un
+        # masque sur toute la table par feuille ; une ligne par commune, sans agrégation
+        by_indic = df[["indicateur","CODGEO_2025","Commune","annee","nombre","Population"]].groupby("indicateur", observed=True)
+        for indic, subset in by_indic:
+            subset = subset.drop(columns="indicateur").rename(columns={"nombre":"Total_crimes"})
             subset["Taux_pour_mille"] = (subset["Total_crimes"]/subset["Population"])*1000
             sheet_name = indic[:31]
-            subset.to_excel(writer, sheet_name=sheet_name, index=False)
+            _write_sheet(writer, sheet_name, subset)
     return output.getvalue()
 
 # ----------------------------------
 # UI
 # ----------------------------------
 st.title("🚨 Dashboard Criminalité France")
-df_raw, file_used = load_crime_data()
+file_used = crime_source()
 communes_ref = load_communes_ref()
 
 st.sidebar.header("📂 Filtres")
 niveau = st.sidebar.radio("Niveau d'analyse", ["France","Commune spécifique"])
 if niveau=="Commune spécifique":
-    commune_choice = st.sidebar.selectbox("Commune", sorted(communes_ref["Commune"].dropna().unique()))
+    commune_choice = st.sidebar.selectbox("Commune", sorted_commune_names())
 else:
     commune_choice = "France"
 
-annee_choice = st.sidebar.selectbox("Année", sorted(df_raw["annee"].dropna().unique(), reverse=True))
-all_indics = ["Tous les crimes confondus"] + sorted(df_raw["indicateur"].dropna().unique())
+dep_sel = st.sidebar.selectbox("Département", ["Tous"] + list(dep_list()))
+dep_choice = None if dep_sel=="Tous" else dep_sel
+
+annee_choice = st.sidebar.selectbox("Année", sorted_years())
+all_indics = ["Tous les crimes confondus"] + list(sorted_indicateurs())
 indic_choice = st.sidebar.selectbox("Indicateur", all_indics)
 
-# Tabs
-tab1, tab2, tab3, tab4, tab5, tab6, tab7 = st.tabs([
+# Tabs : seul l'onglet affiché est calculé (rerun au changement d'onglet)
+TAB_LABELS = [
     "🗺️ Carte","📊 Répartition","🏆 Classements",
     "📈 Evolutions","🔥 Heatmap","🔍 Recherche","⚖️ Comparaison"
-])
+]
+try:
+    tab1, tab2, tab3, tab4, tab5, tab6, tab7 = st.tabs(TAB_LABELS, key="active_tab", on_change="rerun")
+except TypeError:
+    # Streamlit sans onglets paresseux : tous les onglets sont calculés
+    tab1, tab2, tab3, tab4, tab5, tab6, tab7 = st.tabs(TAB_LABELS)
+
+def tab_is_open(tab):
+    """False only for a tab known to be hidden (None when state is not tracked)."""
+    return getattr(tab, "open", None) is not False
+
+def tab_widget(widget, label, *args, key, default, **kwargs):
+    """Widget inside a lazy tab, keeping its value while the tab is hidden."""
+    # Streamlit oublie l'état d'un widget non affiché : la valeur est recopiée sous
+    # une clé simple et réinjectée quand l'onglet est rouvert
+    saved = f"_saved_{key}"
+    if key not in st.session_state:
+        st.session_state[key] = st.session_state.get(saved, default)
+    value = widget(label, *args, key=key, **kwargs)
+    st.session_state[saved] = value
+    return value
 
 # ----------------------
 # Carte
 with tab1:
-    st.header("🗺️ Carte par département")
-    df = prepare_data(annee_choice, None if commune_choice=="France" else [commune_choice])
-    df_map = df.groupby(["DEP","indicateur"],dropna=False)["nombre"].sum().reset_index()
-    if indic_choice=="Tous les crimes confondus":
-        df_map = df_map.groupby("DEP",as_index=False)["nombre"].sum()
-    else:
-        df_map = df_map[df_map["indicateur"]==indic_choice]
-    safe_chart(df_map, lambda d: px.choropleth_mapbox(
-        d, geojson=DEPARTEMENTS_GEOJSON,
-        locations="DEP", featureidkey="properties.code",
-        color="nombre", color_continuous_scale="Reds",
-        mapbox_style="carto-positron",
-        zoom=4.5, center={"lat":46.6,"lon":2.5}, opacity=0.7
-    ))
+    if tab_is_open(tab1):
+        st.header("🗺️ Carte par département")
+        df_map = map_frame(annee_choice, indic_choice, commune_choice, dep_choice)
+        # Seuls les départements présents sont envoyés au navigateur
+        map_geojson = dep_geojson_subset(tuple(sorted(df_map["DEP"].astype(str).unique())))
+        safe_chart(df_map, lambda d: px.choropleth_mapbox(
+            d, geojson=map_geojson,
+            locations="DEP", featureidkey="properties.code",
+            color="nombre", color_continuous_scale="Reds",
+            range_color=(0, d["nombre"].max()),
+            mapbox_style="carto-positron",
+            zoom=4.5, center={"lat":46.6,"lon":2.5}, opacity=0.7
+        ))
 
 # ----------------------
 # Répartition
 with tab2:
-    st.header("📊 Répartition")
-    df = prepare_data(annee_choice, None if commune_choice=="France" else [commune_choice])
-    subset = df.groupby("indicateur", as_index=False)["nombre"].sum() if indic_choice=="Tous les crimes confondus" else df[df["indicateur"]==indic_choice]
-    st.dataframe(subset)
-    if not subset.empty:
-        safe_chart(subset, lambda d: px.pie(d,names="indicateur",values="nombre",title="Répartition"))
+    if tab_is_open(tab2):
+        st.header("📊 Répartition")
+        subset = repartition_frame(annee_choice, indic_choice, commune_choice, dep_choice)
+        st.dataframe(subset)
+        if not subset.empty:
+            safe_chart(subset, lambda d: px.pie(d,names="indicateur",values="nombre",title="Répartition"))
 
 # ----------------------
 # Classements
 with tab3:
-    st.header("🏆 Classements")
-    df = prepare_data(annee_choice)
-    n = st.slider("Nombre de communes",10,100,15)
-    top = compute_ranking(df, indic_choice, n)
-    st.dataframe(top)
-
-    st.subheader("📥 Export Excel")
-    excel_data = create_excel_rankings(df, annee_choice)
-    st.download_button(
-        label="💾 Télécharger le fichier Excel",
-        data=excel_data,
-        file_name=f"classements_{indic_choice}_{annee_choice}.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    )
+    if tab_is_open(tab3):
+        st.header("🏆 Classements")
+        n = tab_widget(st.slider, "Nombre de communes", 10, 100, key="rank_n", default=15)
+        top = compute_ranking(annee_choice, indic_choice, dep_choice, n)
+        st.dataframe(top)
+
+        st.subheader("📥 Export Excel")
+        # Classeur généré seulement au clic sur le bouton, pas à chaque affichage
+        st.download_button(
+            label="💾 Télécharger le fichier Excel",
+            data=partial(create_excel_rankings, annee_choice, dep_choice),
+            file_name=f"classements_{indic_choice}_{annee_choice}.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
 
 # ----------------------
 # Evolutions
 with tab4:
-    st.header("📈 Evolutions temporelles")
-    df_all = prepare_data(None, None if commune_choice=="France" else [commune_choice], include_all_years=True)
-    if indic_choice=="Tous les crimes confondus":
-        top_indics = df_all.groupby("indicateur")["nombre"].sum().nlargest(10).index
-        subset = df_all[df_all["indicateur"].isin(top_indics)]
-        safe_chart(subset, lambda d: px.line(d,x="annee",y="nombre",color="indicateur"))
-    else:
-        subset = df_all[df_all["indicateur"]==indic_choice]
-        safe_chart(subset, lambda d: px.line(d,x="annee",y="nombre"))
+    if tab_is_open(tab4):
+        st.header("📈 Evolutions temporelles")
+        subset = evolution_frame(indic_choice, commune_choice, dep_choice)
+        if indic_choice=="Tous les crimes confondus":
+            safe_chart(subset, lambda d: px.line(d,x="annee",y="nombre",color="indicateur"))
+        else:
+            safe_chart(subset, lambda d: px.line(d,x="annee",y="nombre"))
 
 # ----------------------
 # Heatmap
 with tab5:
-    st.header("🔥 Heatmap")
-    df_h = prepare_data(None, None if commune_choice=="France" else [commune_choice], include_all_years=True)
-    pivot = df_h.groupby(["annee","indicateur"],as_index=False)["nombre"].sum().pivot(index="indicateur",columns="annee",values="nombre")
-    safe_chart(pivot.reset_index(), lambda d: px.imshow(d.set_index("indicateur"),aspect="auto",color_continuous_scale="Reds"))
+    if tab_is_open(tab5):
+        st.header("🔥 Heatmap")
+        pivot = heatmap_pivot(commune_choice, dep_choice)
+        safe_chart(pivot.reset_index(), lambda d: px.imshow(d.set_index("indicateur"),aspect="auto",color_continuous_scale="Reds"))
 
 # ----------------------
 # Recherche
 with tab6:
-    st.header("🔍 Recherche")
-    search = st.text_input("Commune à rechercher")
-    if search:
-        matches = communes_ref[communes_ref["Commune"].str.contains(search,case=False,na=False)]
-        if not matches.empty:
-            commune_sel = st.selectbox("Choisir", matches["Commune"].unique())
-            df_r = prepare_data(None,[commune_sel],include_all_years=True)
-            safe_chart(df_r, lambda d: px.line(d,x="annee",y="nombre",color="indicateur"))
-            df_y = df_r[df_r["annee"]==annee_choice]
-            safe_chart(df_y, lambda d: px.bar(d,x="indicateur",y="nombre"))
+    if tab_is_open(tab6):
+        st.header("🔍 Recherche")
+        search = tab_widget(st.text_input, "Commune à rechercher", key="search_text", default="")
+        if search:
+            mask = pc.match_substring(commune_names_lower(), search.lower()).fill_null(False)
+            matches = communes_ref[mask.to_numpy(zero_copy_only=False)].drop_duplicates("CODGEO_2025")
+            if not matches.empty:
+                # Choix par code INSEE : les homonymes restent distincts
+                labels = dict(zip(matches["CODGEO_2025"], matches["Commune"].astype(str)))
+                if st.session_state.get("_saved_search_code") not in labels:
+                    st.session_state.pop("_saved_search_code", None)
+                codgeo_sel = tab_widget(
+                    st.selectbox, "Choisir", list(labels), key="search_code",
+                    default=next(iter(labels)), format_func=lambda c: f"{labels[c]} ({c})"
+                )
+                df_r = commune_history(codgeo_sel)
+                evol_r = df_r.groupby(["annee","indicateur"],observed=True,as_index=False)["nombre"].sum()
+                safe_chart(evol_r, lambda d: px.line(d,x="annee",y="nombre",color="indicateur"))
+                df_y = df_r[df_r["annee"]==annee_choice]
+                safe_chart(df_y, lambda d: px.bar(d,x="indicateur",y="nombre"))
 
 # ----------------------
 # Comparaison
 with tab7:
-    st.header("⚖️ Comparaison")
-    communes_compare = st.multiselect("Communes",sorted(communes_ref["Commune"].dropna().unique()))
-    if communes_compare:
-        dfc = prepare_data(annee_choice, communes_compare)
-        safe_chart(dfc, lambda d: px.bar(d,x="indicateur",y="nombre",color="Commune",barmode="group"))
-        safe_chart(dfc, lambda d: px.line_polar(d,r="nombre",theta="indicateur",color="Commune",line_close=True))
+    if tab_is_open(tab7):
+        st.header("⚖️ Comparaison")
+        communes_compare = tab_widget(st.multiselect, "Communes", sorted_commune_names(), key="compare_communes", default=[])
+        if communes_compare:
+            dfc = prepare_data(annee_choice, tuple(sorted(communes_compare)))
+            safe_chart(dfc, lambda d: px.bar(d,x="indicateur",y="nombre",color="Commune",barmode="group"))
+            safe_chart(dfc, lambda d: px.line_polar(d,r="nombre",theta="indicateur",color="Commune",line_close=True))
 
 st.caption(f"📊 Données: Ministère de l'Intérieur – Source fichier: {file_used}")
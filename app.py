@@ -1,8 +1,13 @@
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import plotly.express as px
 import streamlit as st
-import requests
-from io import BytesIO
+from convert_to_parquet import OUTPUT_PARQUET, derive_dep, rate_per_thousand
+from dashboard_common import enable_copy_on_write, ensure_crime_files, load_dep_geojson
+
+enable_copy_on_write()
 
 # Configuration de la page
 st.set_page_config(
@@ -16,93 +21,153 @@ st.set_page_config(
 # ----
 @st.cache_data
 def load_crime_data():
-    url_latest = "https://static.data.gouv.fr/resources/bases-statistiques-communale-departementale-et-regionale-de-la-delinquance-enregistree-par-la-police-et-la-gendarmerie-nationales/20250710-144817/donnee-data.gouv-2024-geographie2025-produit-le2025-06-04.csv.gz"
-    df["annee"] = pd.to_numeric(df["annee"], errors="coerce")
-    df["nombre"] = pd.to_numeric(df["nombre"], errors="coerce")
-    df["taux_pour_mille"] = (
-        df["taux_pour_mille"].str.replace(",", ".", regex=False).astype(float)
-    )
-    return df, url_latest
+    # Parquet typé produit par convert_to_parquet.py (reconstruit s'il manque ou
+    # s'il est plus ancien que le CSV source) : annee int16, nombre int32,
+    # indicateur en dictionnaire (catégorie). Seules les colonnes utilisées sont lues,
+    # commune et population étant jointes par build_master (le taux est recalculé)
+    columns = ["CODGEO_2025", "annee", "indicateur", "nombre"]
+    source_file = ensure_crime_files(columns)
+    df = pd.read_parquet(OUTPUT_PARQUET, engine="pyarrow", columns=columns)
+    return df, source_file
 
 @st.cache_data
 def load_communes_ref():
     df_ref = pd.read_csv("v_commune_2025.csv", dtype=str)
-    return df_ref[["COM", "LIBELLE"]].rename(columns={"COM": "CODGEO_2025", "LIBELLE": "Commune"})
+    df_ref = df_ref[["COM", "LIBELLE"]].rename(columns={"COM": "CODGEO_2025", "LIBELLE": "Commune"})
+    df_ref["Commune"] = df_ref["Commune"].astype("category")
+    return df_ref
 
 @st.cache_data
 def load_population_data():
-    df_pop = pd.read_csv("population_long.csv", dtype={"codgeo": str, "annee": int})
-    df_pop["codgeo"] = df_pop["codgeo"].str.zfill(5)
-    return df_pop.rename(columns={"codgeo": "CODGEO"})
+    df_pop = pd.read_csv("population_long.csv", dtype={"codgeo": str, "annee": "int16", "Population": "float32"})
+    df_pop["codgeo"] = pc.utf8_lpad(pa.array(df_pop["codgeo"]), width=5, padding="0").to_pandas()
+    # Indexée une fois (code, année) : la jointure réutilise l'index en cache
+    return df_pop.rename(columns={"codgeo": "CODGEO"}).set_index(["CODGEO", "annee"])["Population"]
 
 
-def prepare_data(annee_choice=None, communes_choice=None, dep_choice=None):
-    df_crime, source_url = load_crime_data()
-    df_ref = load_communes_ref()
+@st.cache_data
+def build_master():
+    df_crime, source_file = load_crime_data()
+    # Les communes déléguées partagent le code de leur commune nouvelle
+    df_ref = load_communes_ref().drop_duplicates("CODGEO_2025")
     df_pop = load_population_data()
 
-    # Merge avec libellés communes
-    df_crime = df_crime.merge(df_ref, on="CODGEO_2025", how="left")
+    # Catégories de codes communes partagées par les trois tables (2A/2B et
+    # outre-mer compris) : les jointures se font sur les codes entiers
+    codes = pd.CategoricalDtype(sorted(
+        set(df_crime["CODGEO_2025"].dropna()) | set(df_ref["CODGEO_2025"].dropna()) | set(df_pop.index.levels[0])
+    ))
+    df_crime = df_crime.assign(CODGEO_2025=df_crime["CODGEO_2025"].astype(codes))
+    df_ref = df_ref.assign(CODGEO_2025=df_ref["CODGEO_2025"].astype(codes))
+    df_pop = df_pop.set_axis(df_pop.index.set_levels(df_pop.index.levels[0].astype(codes), level=0))
 
-    # Filtrer au plus tôt
-    if annee_choice is not None:
-        df_crime = df_crime[df_crime["annee"] == annee_choice]
+    # Jointures faites une seule fois sur la table complète, puis mises en cache
+    df = df_crime.merge(df_ref, on="CODGEO_2025", how="left", validate="many_to_one")
+    df = df.join(df_pop, on=["CODGEO_2025", "annee"], validate="many_to_one")
 
-    if communes_choice:
-        df_crime = df_crime[df_crime["Commune"].isin(communes_choice)]
+    # Département dérivé sur les codes communes uniques puis reporté par code
+    df["CODGEO_2025"] = df["CODGEO_2025"].cat.remove_unused_categories()
+    df["DEP"] = derive_dep(df["CODGEO_2025"])
+
+    df["taux_calcule_pour_mille"] = rate_per_thousand(df["nombre"], df["Population"])
 
+    # Clés de regroupement en catégories : codes entiers plutôt que chaînes
+    for c in ("indicateur", "Commune"):
+        df[c] = df[c].astype("category")
+    return df, source_file
+
+@st.cache_data
+def dep_cube():
+    # Agrégat précoce (année, département, indicateur) : quelques milliers de lignes
+    df, _ = build_master()
+    return df.groupby(["annee", "DEP", "indicateur"], observed=True, as_index=False, sort=False)["nombre"].sum()
+
+@st.cache_data
+def dep_cube_year(annee_choice, dep_choice=None):
+    # Tranche d'une année (~100 départements × indicateurs), partagée par la carte et la répartition
+    cube = dep_cube()
+    cube = cube[cube["annee"] == annee_choice]
     if dep_choice:
-        df_crime = df_crime[df_crime["CODGEO_2025"].str.startswith(dep_choice)]
-
-    # Seulement maintenant merge avec population
-    df = df_crime.merge(
-        df_pop,
-        left_on=["CODGEO_2025", "annee"],
-        right_on=["CODGEO", "annee"],
-        how="left"
-    )
+        cube = cube[cube["DEP"] == dep_choice]
+    return cube
 
-    df["taux_calcule_pour_mille"] = (df["nombre"] / df["Population"]) * 1000
-    return df, source_url
+@st.cache_data
+def sidebar_options():
+    # Listes du menu calculées une fois : données immuables entre deux reruns
+    df, _ = build_master()
+    years = sorted(df["annee"].dropna().unique())
+    indics = sorted(df["indicateur"].cat.categories)
+    communes = sorted(load_communes_ref()["Commune"].dropna().unique())
+    deps = sorted(df["DEP"].cat.categories)
+    return years, indics, communes, deps
 
-# ----
-# 2. DONNÉES
-# ----
-df, source_url = prepare_data(
-    annee_choice=annee_choice,
-    communes_choice=[commune_choice] if niveau == "Commune spécifique" else None,
-    dep_choice=dep
-)
+@st.cache_data
+def commune_search_index():
+    # Codes et libellés du référentiel (minuscules précalculées), une fois pour la recherche
+    ref = load_communes_ref().dropna(subset=["Commune"])
+    names = ref["Commune"].to_numpy(dtype=str)
+    return ref["CODGEO_2025"].to_numpy(dtype=str), names, np.char.lower(names)
+
+# Une entrée par combinaison de filtres : nombre borné, la table complète
+# reste l'unique jointure (build_master)
+@st.cache_data(max_entries=32)
+def prepare_data(annee_choice=None, communes_choice=None, dep_choice=None):
+    df, source_file = build_master()
+
+    # Uniquement des masques booléens sur la table enrichie en cache
+    if annee_choice is not None:
+        df = df[df["annee"] == annee_choice]
 
-if df is None:
-    st.error("Impossible de charger les données. Vérifiez votre connexion internet.")
-    st.stop()
+    if communes_choice:
+        if len(communes_choice) == 1:
+            df = df[df["Commune"] == communes_choice[0]]
+        else:
+            df = df[df["Commune"].isin(communes_choice)]
+
+    if dep_choice:
+        df = df[df["DEP"] == dep_choice]
+
+    return df, source_file
 
 # ----
-# 3. INTERFACE
+# 2. INTERFACE
 # ----
 st.title("🚨 Dashboard Criminalité France")
-st.markdown(f"**Source :** {source_url}")
+st.markdown(f"**Source :** Ministère de l'Intérieur – fichier {load_crime_data()[1]}")
 
 # Sidebar
 st.sidebar.header("📂 Filtres")
 
+years, indics, communes, deps = sidebar_options()
 niveau = st.sidebar.radio("Niveau d'analyse", ["France", "Commune spécifique"])
 if niveau == "Commune spécifique":
-    commune_choice = st.sidebar.selectbox("Choisir une commune", sorted(df["Commune"].dropna().unique()))
+    commune_choice = st.sidebar.selectbox("Choisir une commune", communes)
 else:
     commune_choice = "France"
 
-annee_choice = st.sidebar.selectbox("Année", sorted(df["annee"].dropna().unique()))
-all_indics = ["Tous les crimes confondus"] + sorted(df["indicateur"].dropna().unique())
+dep_sel = st.sidebar.selectbox("Département", ["Tous"] + deps)
+dep = None if dep_sel == "Tous" else dep_sel
+
+annee_choice = st.sidebar.selectbox("Année", years)
+all_indics = ["Tous les crimes confondus"] + indics
 indic_choice = st.sidebar.selectbox("Indicateur", all_indics)
 
 communes_compare = st.sidebar.multiselect(
     "Comparer plusieurs communes",
-    sorted(df["Commune"].dropna().unique()),
+    communes,
     default=["Paris", "Lyon", "Marseille"]
 )
 
+# ----
+# 3. DONNÉES
+# ----
+communes_filter = (commune_choice,) if niveau == "Commune spécifique" else None
+# df ne contient que l'année choisie (filtrée dans prepare_data) : les onglets
+# par année (carte, répartition, classements, comparaison) ne refiltrent pas sur annee_choice
+df, _ = prepare_data(annee_choice=annee_choice, communes_choice=communes_filter, dep_choice=dep)
+# Toutes les années, mêmes filtres : séries d'Évolutions et colonnes de la Heatmap
+df_years, _ = prepare_data(annee_choice=None, communes_choice=communes_filter, dep_choice=dep)
+
 # ----
 # 4. ONGLET PRINCIPAL
 # ----
@@ -114,18 +179,22 @@ tab1, tab2, tab3, tab4, tab5, tab6, tab7 = st.tabs([
 # ONGLET 1 : CARTE
 with tab1:
     st.header("🗺️ Carte interactive par département")
-    df_map = df.groupby(["annee", "DEP", "indicateur"])["nombre"].sum().reset_index()
+    if niveau == "France":
+        df_map = dep_cube_year(annee_choice, dep)
+    else:
+        df_map = df
+    # Filtre indicateur d'abord, puis un seul groupby par département
     if indic_choice == "Tous les crimes confondus":
-        df_map_filtered = df_map.groupby(["annee", "DEP"], as_index=False)["nombre"].sum()
         title_map = "Évolution: Tous les crimes confondus"
     else:
-        df_map_filtered = df_map[df_map["indicateur"] == indic_choice]
+        df_map = df_map[df_map["indicateur"] == indic_choice]
         title_map = f"Évolution: {indic_choice}"
+    df_map_filtered = df_map.groupby("DEP", as_index=False, observed=True, sort=False)["nombre"].sum()
 
     if not df_map_filtered.empty:
         fig_map = px.choropleth_mapbox(
             df_map_filtered,
-            geojson="https://france-geojson.gregoiredavid.fr/repo/departements.geojson",
+            geojson=load_dep_geojson(),
             locations="DEP",
             featureidkey="properties.code",
             color="nombre",
@@ -147,17 +216,17 @@ with tab2:
     st.header("📊 Répartition des crimes")
     if commune_choice == "France":
         if indic_choice == "Tous les crimes confondus":
-            subset = df[df["annee"] == annee_choice].groupby("indicateur", as_index=False)["nombre"].sum()
+            subset = dep_cube_year(annee_choice, dep).groupby("indicateur", as_index=False, observed=True, sort=False)["nombre"].sum()
             title = f"Répartition des crimes en France en {annee_choice}"
         else:
-            subset = df[(df["annee"] == annee_choice) & (df["indicateur"] == indic_choice)]
+            subset = df[df["indicateur"] == indic_choice]
             title = f"{indic_choice} en France en {annee_choice}"
     else:
         if indic_choice == "Tous les crimes confondus":
-            subset = df[(df["Commune"] == commune_choice) & (df["annee"] == annee_choice)].groupby("indicateur", as_index=False)["nombre"].sum()
+            subset = df[df["Commune"] == commune_choice].groupby("indicateur", as_index=False, observed=True, sort=False)["nombre"].sum()
             title = f"Répartition des crimes à {commune_choice} en {annee_choice}"
         else:
-            subset = df[(df["Commune"] == commune_choice) & (df["annee"] == annee_choice) & (df["indicateur"] == indic_choice)]
+            subset = df[(df["Commune"] == commune_choice) & (df["indicateur"] == indic_choice)]
             title = f"{indic_choice} à {commune_choice} en {annee_choice}"
 
     if not subset.empty:
@@ -178,32 +247,26 @@ with tab2:
 with tab3:
     st.header("🏆 Classement des communes")
     n_communes = st.slider("Nombre de communes à afficher", 10, 100, 15)
-    df_year = df[df["annee"] == annee_choice].copy()
-    if indic_choice != "Tous les crimes confondus":
-        df_year = df_year[df_year["indicateur"] == indic_choice]
+    df_year = df if indic_choice == "Tous les crimes confondus" else df[df["indicateur"] == indic_choice]
 
-    top_nombre = (
-        df_year.groupby(["Commune", "CODGEO_2025"], as_index=False)
-        .agg(Total_crimes=("nombre", "sum"), Population=("Population", "first"))
-        .sort_values("Total_crimes", ascending=False)
-        .head(n_communes)
-    )
+    # Une seule agrégation, deux sélections partielles (nombre puis taux)
     taux_rank = (
-        df_year.groupby(["Commune", "CODGEO_2025"], as_index=False)
+        df_year.groupby(["Commune", "CODGEO_2025"], as_index=False, observed=True, sort=False)
         .agg(Total_crimes=("nombre", "sum"), Population=("Population", "first"))
     )
+    top_nombre = taux_rank.nlargest(n_communes, "Total_crimes")
     taux_rank["Taux_pour_mille"] = (taux_rank["Total_crimes"] / taux_rank["Population"]) * 1000
-    top_taux = taux_rank.sort_values("Taux_pour_mille", ascending=False).head(n_communes)
+    top_taux = taux_rank.nlargest(n_communes, "Taux_pour_mille")
 
     col1, col2 = st.columns(2)
     with col1:
         st.subheader(f"Top {n_communes} communes par nombre - {indic_choice} ({annee_choice})")
-        st.dataframe(top_nombre.reset_index(drop=True))
+        st.dataframe(top_nombre, hide_index=True)
         if not top_nombre.empty:
             st.plotly_chart(px.bar(top_nombre, x="Commune", y="Total_crimes", color="Total_crimes", color_continuous_scale="Blues"), use_container_width=True)
     with col2:
         st.subheader(f"Top {n_communes} communes par taux pour 1000 - {indic_choice} ({annee_choice})")
-        st.dataframe(top_taux.reset_index(drop=True))
+        st.dataframe(top_taux, hide_index=True)
         if not top_taux.empty:
             st.plotly_chart(px.bar(top_taux, x="Commune", y="Taux_pour_mille", color="Taux_pour_mille", color_continuous_scale="Reds"), use_container_width=True)
 
@@ -212,18 +275,18 @@ with tab4:
     st.header("📈 Évolutions temporelles")
     if commune_choice == "France":
         if indic_choice == "Tous les crimes confondus":
-            subset_evol = df.groupby(["annee", "indicateur"])["nombre"].sum().reset_index()
+            subset_evol = df_years.groupby(["annee", "indicateur"], as_index=False, observed=True)["nombre"].sum()
             title_evol = "Évolution des crimes en France"
         else:
-            subset_evol = df[df["indicateur"] == indic_choice].groupby(["annee"])["nombre"].sum().reset_index()
+            subset_evol = df_years[df_years["indicateur"] == indic_choice].groupby(["annee"], as_index=False, observed=True)["nombre"].sum()
             subset_evol["indicateur"] = indic_choice
             title_evol = f"Évolution: {indic_choice} en France"
     else:
         if indic_choice == "Tous les crimes confondus":
-            subset_evol = df[df["Commune"] == commune_choice].groupby(["annee", "indicateur"])["nombre"].sum().reset_index()
+            subset_evol = df_years[df_years["Commune"] == commune_choice].groupby(["annee", "indicateur"], as_index=False, observed=True)["nombre"].sum()
             title_evol = f"Évolution: {commune_choice}"
         else:
-            subset_evol = df[(df["Commune"] == commune_choice) & (df["indicateur"] == indic_choice)].groupby(["annee"])["nombre"].sum().reset_index()
+            subset_evol = df_years[(df_years["Commune"] == commune_choice) & (df_years["indicateur"] == indic_choice)].groupby(["annee"], as_index=False, observed=True)["nombre"].sum()
             subset_evol["indicateur"] = indic_choice
             title_evol = f"Évolution: {indic_choice} à {commune_choice}"
 
@@ -235,12 +298,15 @@ with tab4:
 # ONGLET 5 : HEATMAP
 with tab5:
     st.header("🔥 Heatmap Année × Indicateur")
-    subset_heat = df.copy() if commune_choice == "France" else df[df["Commune"] == commune_choice]
+    subset_heat = df_years if commune_choice == "France" else df_years[df_years["Commune"] == commune_choice]
     title_heat = "Heatmap des crimes en France" if commune_choice == "France" else f"Heatmap des crimes à {commune_choice}"
     if indic_choice != "Tous les crimes confondus":
         subset_heat = subset_heat[subset_heat["indicateur"] == indic_choice]
         title_heat += f" - {indic_choice}"
-    pivot = subset_heat.groupby(["annee", "indicateur"])["nombre"].sum().reset_index().pivot(index="indicateur", columns="annee", values="nombre").fillna(0)
+        # Un seul indicateur : une ligne, simple somme par année sans pivot
+        pivot = subset_heat.groupby("annee", observed=True)["nombre"].sum().to_frame(indic_choice).T
+    else:
+        pivot = subset_heat.pivot_table(index="indicateur", columns="annee", values="nombre", aggfunc="sum", observed=True, fill_value=0, sort=False)
     if not pivot.empty:
         st.plotly_chart(px.imshow(pivot, aspect="auto", labels=dict(x="Année", y="Indicateur", color="Nombre"), title=title_heat, color_continuous_scale="Reds"), use_container_width=True)
 
@@ -249,18 +315,26 @@ with tab6:
     st.header("🔍 Recherche par commune")
     search_term = st.text_input("Tapez le nom d'une commune:", placeholder="Ex: Paris, Lyon...")
     if search_term:
-        matches = df[df["Commune"].str.contains(search_term, case=False, na=False)]["Commune"].unique()
-        if len(matches) > 0:
-            st.success(f"🎯 {len(matches)} commune(s) trouvée(s)")
-            selected_commune = st.selectbox("Choisir:", matches)
-            if selected_commune:
-                commune_data = df[df["Commune"] == selected_commune]
+        codes, names, names_lower = commune_search_index()
+        hit = np.char.find(names_lower, search_term.lower()) >= 0
+        # Choix par code INSEE : les homonymes restent distincts (premier libellé par code)
+        labels = {}
+        for code, name in zip(codes[hit], names[hit]):
+            labels.setdefault(code, name)
+        if labels:
+            st.success(f"🎯 {len(labels)} commune(s) trouvée(s)")
+            selected_code = st.selectbox("Choisir:", list(labels), format_func=lambda c: f"{labels[c]} ({c})")
+            if selected_code:
+                selected_commune = labels[selected_code]
+                # Toutes les années de la commune, par son code, sans repasser par prepare_data
+                master, _ = build_master()
+                commune_data = master[master["CODGEO_2025"] == selected_code]
                 st.metric("Total crimes", f"{commune_data['nombre'].sum():,}")
                 st.metric("Années dispo", len(commune_data['annee'].unique()))
                 st.metric("Types crimes", len(commune_data['indicateur'].unique()))
-                summary = commune_data.groupby(["annee", "indicateur"])["nombre"].sum().reset_index().pivot(index="indicateur", columns="annee", values="nombre").fillna(0)
+                summary = commune_data.pivot_table(index="indicateur", columns="annee", values="nombre", aggfunc="sum", observed=True, fill_value=0, sort=False)
                 st.dataframe(summary)
-                evol = commune_data.groupby(["annee", "indicateur"])["nombre"].sum().reset_index()
+                evol = commune_data.groupby(["annee", "indicateur"], as_index=False, observed=True)["nombre"].sum()
                 st.plotly_chart(px.line(evol, x="annee", y="nombre", color="indicateur", title=f"Évolution {selected_commune}"), use_container_width=True)
         else:
             st.warning("❌ Aucune commune trouvée")
@@ -269,11 +343,11 @@ with tab6:
 with tab7:
     st.header("⚖️ Comparaison entre communes")
     if communes_compare:
-        subset_compare = df[(df["Commune"].isin(communes_compare)) & (df["annee"] == annee_choice)]
+        subset_compare = df[df["Commune"].isin(communes_compare)]
         st.plotly_chart(px.bar(subset_compare, x="indicateur", y="nombre", color="Commune", barmode="group", title=f"Comparaison {annee_choice}"), use_container_width=True)
-        top_indics = subset_compare.groupby("indicateur")["nombre"].sum().nlargest(8).index.tolist()
+        top_indics = subset_compare.groupby("indicateur", observed=True, sort=False)["nombre"].sum().nlargest(8).index.tolist()
         radar_data = subset_compare[subset_compare["indicateur"].isin(top_indics)]
-        radar_pivot = radar_data.pivot_table(index="indicateur", columns="Commune", values="nombre", fill_value=0)
+        radar_pivot = radar_data.pivot_table(index="indicateur", columns="Commune", values="nombre", aggfunc="sum", observed=True, fill_value=0)
         radar_long = radar_pivot.reset_index().melt(id_vars="indicateur", var_name="Commune", value_name="nombre")
         st.plotly_chart(px.line_polar(radar_long, r="nombre", theta="indicateur", color="Commune", line_close=True, title=f"Radar Top {len(top_indics)} {annee_choice}"), use_container_width=True)
     else:
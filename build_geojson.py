@@ -0,0 +1,126 @@
+import json
+import os
+import sys
+from update_crime_data import http_get_with_retry
+
+# Génération ponctuelle d'un GeoJSON des départements allégé pour la carte
+SOURCE_URL = "https://france-geojson.gregoiredavid.fr/repo/departements.geojson"
+OUTPUT_GEOJSON = "departements_simplified.geojson"
+KEEP_PROPERTIES = ("code", "nom")
+TOLERANCE = 0.005      # en degrés (~500 m), invisible à l'échelle nationale
+COORD_PRECISION = 4    # ~10 m
+
+def _perp_dist(p, a, b):
+    (x, y), (x1, y1), (x2, y2) = p, a, b
+    dx, dy = x2 - x1, y2 - y1
+    if dx == 0 and dy == 0:
+        return ((x - x1) ** 2 + (y - y1) ** 2) ** 0.5
+    return abs(dy * x - dx * y + x2 * y1 - y2 * x1) / (dx * dx + dy * dy) ** 0.5
+
+def simplify_line(points, tolerance=TOLERANCE):
+    # Douglas-Peucker itératif (pas de récursion sur les longs contours)
+    if len(points) < 3:
+        return points
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        idx, dmax = None, tolerance
+        for i in range(start + 1, end):
+            d = _perp_dist(points[i], points[start], points[end])
+            if d > dmax:
+                idx, dmax = i, d
+        if idx is not None:
+            keep[idx] = True
+            stack.extend([(start, idx), (idx, end)])
+    return [p for p, k in zip(points, keep) if k]
+
+# Simplification topologique : une frontière commune à deux départements est
+# découpée en arcs entre jonctions, chaque arc est simplifié une seule fois et
+# réutilisé (à l'envers) par le voisin, sans trou ni chevauchement le long des limites.
+def feature_polygons(feature):
+    geom = feature["geometry"]
+    return [geom["coordinates"]] if geom["type"] == "Polygon" else geom["coordinates"]
+
+def find_junctions(rings):
+    # Jonction : point rencontré avec des voisins différents d'un anneau à l'autre
+    # (début ou fin d'une frontière partagée)
+    neighbours, junctions = {}, set()
+    for ring in rings:
+        pts = [tuple(p) for p in ring[:-1]]
+        n = len(pts)
+        for i, p in enumerate(pts):
+            pair = frozenset((pts[i - 1], pts[(i + 1) % n]))
+            if neighbours.setdefault(p, pair) != pair:
+                junctions.add(p)
+    return junctions
+
+def split_ring(pts, junctions):
+    # Arcs entre jonctions successives ; anneau sans jonction : un arc fermé
+    # qui commence au plus petit point (même découpage vu des deux côtés)
+    cuts = [i for i, p in enumerate(pts) if p in junctions]
+    if not cuts:
+        start = pts.index(min(pts))
+        return [pts[start:] + pts[:start + 1]]
+    pts = pts[cuts[0]:] + pts[:cuts[0]]
+    cuts = [c - cuts[0] for c in cuts] + [len(pts)]
+    pts = pts + pts[:1]
+    return [pts[a:b + 1] for a, b in zip(cuts, cuts[1:])]
+
+def simplify_arc(arc, cache):
+    # Orientation canonique : l'arc et son inverse partagent la même simplification
+    rev = arc[::-1]
+    key = min(tuple(arc), tuple(rev))
+    if key not in cache:
+        cache[key] = simplify_line(list(key))
+    return cache[key] if key == tuple(arc) else cache[key][::-1]
+
+def simplify_ring(ring, junctions, cache):
+    pts = [tuple(p) for p in ring[:-1]]
+    out = []
+    for arc in split_ring(pts, junctions):
+        out.extend(simplify_arc(arc, cache)[:-1])
+    ring = [[round(x, COORD_PRECISION), round(y, COORD_PRECISION)] for x, y in out + out[:1]]
+    # Un anneau fermé doit garder au moins 4 points
+    return ring if len(ring) >= 4 else None
+
+def simplify_polygon(polygon, junctions, cache):
+    rings = [simplify_ring(r, junctions, cache) for r in polygon]
+    if rings[0] is None:
+        return None
+    return [r for r in rings if r is not None]
+
+def simplify_feature(feature, junctions, cache):
+    polygons = [simplify_polygon(p, junctions, cache) for p in feature_polygons(feature)]
+    return {
+        "type": "Feature",
+        "properties": {k: feature["properties"].get(k) for k in KEEP_PROPERTIES},
+        "geometry": {"type": "MultiPolygon", "coordinates": [p for p in polygons if p is not None]},
+    }
+
+def simplify_collection(src):
+    """Topology-preserving simplified copy of a departments FeatureCollection."""
+    rings = [r for f in src["features"] for p in feature_polygons(f) for r in p]
+    junctions, cache = find_junctions(rings), {}
+    return {"type": "FeatureCollection", "features": [simplify_feature(f, junctions, cache) for f in src["features"]]}
+
+def write_geojson(geojson, path=OUTPUT_GEOJSON):
+    # Écrit à côté puis renommé : jamais de fichier tronqué lu par l'application
+    with open(path + ".partial", "w", encoding="utf-8") as f:
+        json.dump(geojson, f, separators=(",", ":"))
+    os.replace(path + ".partial", path)
+
+def main():
+    print(f"Téléchargement depuis:\n{SOURCE_URL}")
+    out = simplify_collection(http_get_with_retry(SOURCE_URL).json())
+    write_geojson(out)
+    print(f"Départements: {len(out['features'])}")
+    print(f"✅ Écrit: {OUTPUT_GEOJSON}")
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        print("❌ ERREUR:", e)
+        sys.exit(1)
@@ -0,0 +1,230 @@
+import os
+import shutil
+import sys
+from typing import Optional
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+
+# Conversion ponctuelle CSV gzip -> Parquet colonnaire (typé, compressé zstd).
+# Le CSV est lu en flux par blocs et réparti par année ; la finalisation (tri, DEP,
+# écriture) se fait une année à la fois : la mémoire reste bornée par une année de données.
+CRIME_CANDIDATES = ["crime_2016_latest.csv.gz", "crime_2016_2024.csv.gz"]
+REF_CSV = "v_commune_2025.csv"
+POP_CSV = "population_long.csv"
+OUTPUT_PARQUET = "crime.parquet"
+OUTPUT_ARROW = "crime.arrow"
+ROW_GROUP_SIZE = 100_000
+CSV_COLUMNS = ["CODGEO_2025", "annee", "indicateur", "nombre", "taux_pour_mille"]
+CSV_TYPES = {
+    "CODGEO_2025": pa.string(),
+    "annee": pa.int16(),
+    "indicateur": pa.string(),
+    "nombre": pa.float64(),
+    "taux_pour_mille": pa.string(),
+}
+# Schéma fixe des blocs enrichis (un bloc peut n'avoir que des valeurs nulles)
+ENRICHED_FIELDS = [
+    ("CODGEO_2025", pa.string()),
+    ("annee", pa.int16()),
+    ("indicateur", pa.string()),
+    ("nombre", pa.int32()),
+    ("taux_pour_mille", pa.float32()),
+    ("Commune", pa.string()),
+    ("Population", pa.float32()),
+]
+DICTIONARY_COLUMNS = ["CODGEO_2025", "indicateur", "Commune"]
+KEY_COLUMNS = ["CODGEO_2025", "annee", "indicateur"]
+OUTPUT_COLUMNS = ["CODGEO_2025", "annee", "indicateur", "nombre", "taux_pour_mille", "DEP", "Commune", "Population"]
+
+def find_crime_source() -> Optional[str]:
+    return next((f for f in CRIME_CANDIDATES if os.path.exists(f)), None)
+
+def outputs_stale(src: str, columns, dst: str = OUTPUT_PARQUET, arrow_dst: str = OUTPUT_ARROW) -> bool:
+    """True if an output is missing, older than a source CSV or lacks one of the columns."""
+    if not (os.path.exists(dst) and os.path.exists(arrow_dst)):
+        return True
+    built = min(os.path.getmtime(dst), os.path.getmtime(arrow_dst))
+    if any(os.path.getmtime(f) > built for f in (src, REF_CSV, POP_CSV)):
+        return True
+    # Seuls les pieds des deux fichiers sont lus (app.py lit le Parquet, app-5.py
+    # l'IPC) ; la source IPC est refermée aussitôt
+    with pa.OSFile(arrow_dst, "rb") as source:
+        names = set(ipc.open_file(source).schema.names)
+    names &= set(pq.read_schema(dst).names)
+    return not set(columns).issubset(names)
+
+def read_communes_ref(path: str = REF_CSV) -> pd.DataFrame:
+    # Seules les deux colonnes utiles sont parsées, directement en chaînes Arrow
+    table = pacsv.read_csv(
+        path,
+        convert_options=pacsv.ConvertOptions(
+            column_types={"COM": pa.string(), "LIBELLE": pa.string()},
+            include_columns=["COM", "LIBELLE"],
+            strings_can_be_null=True,
+        ),
+    )
+    return table.rename_columns(["CODGEO_2025", "Commune"]).to_pandas()
+
+def read_population(path: str = POP_CSV) -> pd.DataFrame:
+    table = pacsv.read_csv(
+        path,
+        convert_options=pacsv.ConvertOptions(
+            # Populations entières < 2^24 : exactes en float32 (NaN possibles)
+            column_types={"codgeo": pa.string(), "annee": pa.int16(), "Population": pa.float32()},
+            include_columns=["codgeo", "annee", "Population"],
+        ),
+    )
+    # Complément à 5 caractères en vectorisé côté Arrow (pas de str.zfill ligne à ligne)
+    codgeo = pc.utf8_lpad(table["codgeo"], width=5, padding="0")
+    pop = pa.table({"CODGEO": codgeo, "annee": table["annee"], "Population": table["Population"]}).to_pandas()
+    return pop.set_index(["CODGEO", "annee"])
+
+def open_crime_csv(src: str) -> pacsv.CSVStreamingReader:
+    # Lecteur CSV Arrow en flux : décompression gzip et tokenisation par blocs,
+    # colonnes typées directement par le parseur
+    return pacsv.open_csv(
+        src,
+        read_options=pacsv.ReadOptions(use_threads=True),
+        parse_options=pacsv.ParseOptions(delimiter=";"),
+        convert_options=pacsv.ConvertOptions(
+            column_types=CSV_TYPES,
+            strings_can_be_null=True,
+        ),
+    )
+
+def enrich_batch(df: pd.DataFrame, ref: pd.DataFrame, pop: pd.DataFrame) -> pd.DataFrame:
+    df = df[[c for c in CSV_COLUMNS if c in df.columns]]
+
+    # nombre peut être vide : lu en flottant, puis comptage sur 32 bits
+    df = df.dropna(subset=["nombre"])
+    df["nombre"] = df["nombre"].astype("int32")
+    if "taux_pour_mille" in df.columns:
+        df["taux_pour_mille"] = pd.to_numeric(
+            df["taux_pour_mille"].str.replace(",", ".", regex=False), errors="coerce"
+        ).astype("float32")
+
+    df["CODGEO_2025"] = df["CODGEO_2025"].str.strip()
+
+    # Dénormalisation : libellé commune et population jointes une seule fois ici,
+    # sur index, validate="m:1" pour détecter tout doublon de clé.
+    df = df.join(ref, on="CODGEO_2025", validate="m:1")
+    return df.join(pop, on=["CODGEO_2025", "annee"], validate="m:1")
+
+def derive_dep(codgeo: pd.Series) -> pd.Series:
+    # Calcul sur les codes communes uniques (catégories), puis report par codes entiers :
+    # ~35k chaînes traitées au lieu d'une par ligne. 3 caractères en outre-mer (97x/98x)
+    cats = codgeo.cat.categories.to_series()
+    p2, p3 = cats.str.slice(0, 2), cats.str.slice(0, 3)
+    # Code trop court pour porter un département : valeur manquante plutôt qu'un préfixe tronqué
+    dep = p2.where(~p2.isin(["97", "98"]), p3).where(cats.str.len() >= 2)
+    dep = pd.Categorical(dep)
+    codes = codgeo.cat.codes.to_numpy()
+    dep_codes = np.where(codes >= 0, dep.codes[codes], -1)
+    return pd.Series(pd.Categorical.from_codes(dep_codes, dep.categories), index=codgeo.index, name="DEP")
+
+def rate_per_thousand(nombre: pd.Series, population: pd.Series) -> np.ndarray:
+    # Division écrite en place dans un tableau prérempli de NaN : seules les lignes
+    # à population positive sont calculées (NaN si population absente ou nulle)
+    pop = population.to_numpy(dtype="float64")
+    rate = np.full(len(pop), np.nan)
+    np.divide(nombre.to_numpy(dtype="float64"), pop, out=rate, where=pop > 0)
+    rate *= 1000
+    return rate
+
+def finish_year(df: pd.DataFrame, categories: dict) -> pd.DataFrame:
+    # Catégories communes à toutes les années (triées) : dictionnaires identiques
+    # d'un bloc à l'autre, requis par le fichier Arrow IPC
+    for c, dtype in categories.items():
+        df[c] = df[c].astype(dtype)
+
+    # Agrégation précoce : une seule ligne par (commune, année, indicateur),
+    # les groupby en aval n'ont jamais à fusionner des doublons de clé
+    if df.duplicated(KEY_COLUMNS).any():
+        aggs = {c: "first" for c in df.columns if c not in KEY_COLUMNS}
+        aggs["nombre"] = "sum"
+        if "taux_pour_mille" in aggs:
+            aggs["taux_pour_mille"] = "mean"
+        df = df.groupby(KEY_COLUMNS, observed=True, as_index=False, sort=False).agg(aggs)
+        df["nombre"] = df["nombre"].astype("int32")
+    df["DEP"] = derive_dep(df["CODGEO_2025"])
+    df = df[[c for c in OUTPUT_COLUMNS if c in df.columns]]
+
+    # Tri par commune dans l'année : avec les années écrites dans l'ordre, les
+    # statistiques min/max des row groups permettent de sauter les blocs hors filtre
+    return df.sort_values("CODGEO_2025", ignore_index=True)
+
+def convert_crime_csv(src: str, dst: str = OUTPUT_PARQUET, arrow_dst: str = OUTPUT_ARROW) -> int:
+    # Les communes déléguées (COMD) partagent le code de leur commune nouvelle,
+    # on ne garde que la première ligne par code pour ne pas dupliquer les faits.
+    ref = read_communes_ref().drop_duplicates("CODGEO_2025").set_index("CODGEO_2025")
+    pop = read_population()
+
+    partial_dir = dst + ".partial"
+    os.makedirs(partial_dir, exist_ok=True)
+    try:
+        # 1) Flux CSV -> un Parquet intermédiaire par année, bloc par bloc ;
+        #    valeurs distinctes des colonnes texte relevées au passage
+        writers = {}
+        seen = {c: set() for c in DICTIONARY_COLUMNS}
+        try:
+            for batch in open_crime_csv(src):
+                df = enrich_batch(batch.to_pandas(), ref, pop)
+                schema = pa.schema([f for f in ENRICHED_FIELDS if f[0] in df.columns])
+                for c in DICTIONARY_COLUMNS:
+                    seen[c].update(df[c].dropna().unique())
+                for annee, part in df.groupby("annee", sort=False):
+                    if annee not in writers:
+                        path = os.path.join(partial_dir, f"{annee}.parquet")
+                        writers[annee] = pq.ParquetWriter(path, schema, compression="zstd")
+                    writers[annee].write_table(pa.Table.from_pandas(part, schema=schema, preserve_index=False))
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+        # 2) Finalisation année par année, écrite à la suite dans le Parquet et dans
+        #    la copie Arrow IPC non compressée (mappée en mémoire par l'application,
+        #    pages partagées entre sessions via le cache du système). L'IPC est écrit
+        #    à côté puis renommé, pour ne pas tronquer un fichier déjà mappé.
+        categories = {c: pd.CategoricalDtype(sorted(seen[c])) for c in DICTIONARY_COLUMNS}
+        n_rows = 0
+        pq_writer = ipc_writer = None
+        with pa.OSFile(arrow_dst + ".partial", "wb") as sink:
+            try:
+                for annee in sorted(writers):
+                    df = finish_year(pq.read_table(os.path.join(partial_dir, f"{annee}.parquet")).to_pandas(), categories)
+                    table = pa.Table.from_pandas(df, preserve_index=False)
+                    if pq_writer is None:
+                        pq_writer = pq.ParquetWriter(dst, table.schema, compression="zstd")
+                        ipc_writer = ipc.new_file(sink, table.schema)
+                    pq_writer.write_table(table, row_group_size=ROW_GROUP_SIZE)
+                    ipc_writer.write_table(table)
+                    n_rows += len(df)
+            finally:
+                if pq_writer is not None:
+                    pq_writer.close()
+                    ipc_writer.close()
+        os.replace(arrow_dst + ".partial", arrow_dst)
+        return n_rows
+    finally:
+        shutil.rmtree(partial_dir, ignore_errors=True)
+
+def main():
+    src = find_crime_source()
+    if src is None:
+        raise FileNotFoundError(f"Aucun fichier source parmi {CRIME_CANDIDATES}")
+    print(f"Conversion: {src} → {OUTPUT_PARQUET}, {OUTPUT_ARROW}")
+    n_rows = convert_crime_csv(src, OUTPUT_PARQUET, OUTPUT_ARROW)
+    print(f"Lignes totales: {n_rows:,}")
+    print(f"✅ Écrit: {OUTPUT_PARQUET}, {OUTPUT_ARROW}")
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        print("❌ ERREUR:", e)
+        sys.exit(1)
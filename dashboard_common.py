@@ -0,0 +1,54 @@
+import os
+import json
+import pandas as pd
+import requests
+import streamlit as st
+from build_geojson import OUTPUT_GEOJSON, SOURCE_URL, simplify_collection, write_geojson
+from convert_to_parquet import CRIME_CANDIDATES, convert_crime_csv, find_crime_source, outputs_stale
+
+# Éléments partagés par les deux versions du tableau de bord
+
+def enable_copy_on_write():
+    # Copy-on-Write : les sous-tables filtrées partagent les tableaux de la table
+    # en cache jusqu'à la première écriture (comportement par défaut dès pandas 3,
+    # où l'option est dépréciée)
+    if int(pd.__version__.split(".")[0]) < 3:
+        pd.set_option("mode.copy_on_write", True)
+
+def crime_source():
+    """Source CSV in use; stops the page when none is present."""
+    src = find_crime_source()
+    if src is None:
+        st.error(f"Aucun fichier source parmi {CRIME_CANDIDATES}")
+        st.stop()
+    return src
+
+def ensure_crime_files(columns):
+    """Source CSV in use, after rebuilding crime.parquet / crime.arrow if stale."""
+    src = crime_source()
+    # Fichiers typés (annee int16, nombre int32, catégories) reconstruits si absents,
+    # plus anciens qu'un CSV source ou privés d'une colonne utilisée
+    if outputs_stale(src, columns):
+        convert_crime_csv(src)
+    return src
+
+@st.cache_data
+def load_dep_geojson():
+    """Simplified departments GeoJSON (see build_geojson.py), built on first download if missing."""
+    if os.path.exists(OUTPUT_GEOJSON):
+        with open(OUTPUT_GEOJSON, encoding="utf-8") as f:
+            return json.load(f)
+    # Téléchargé et parsé une seule fois côté serveur ; l'URL n'est
+    # transmise au navigateur qu'en dernier recours (hors ligne)
+    try:
+        resp = requests.get(SOURCE_URL, timeout=10)
+        resp.raise_for_status()
+        geojson = simplify_collection(resp.json())
+    except (requests.RequestException, ValueError):
+        return SOURCE_URL
+    # Mis en cache sur disque : les démarrages suivants n'ont plus besoin du réseau
+    try:
+        write_geojson(geojson)
+    except OSError:
+        pass
+    return geojson